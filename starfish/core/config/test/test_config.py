@@ -1,9 +1,13 @@
+import contextlib
 import os
+import shutil
+import sys
 import warnings
-from json import dump, loads
+from copy import deepcopy
+from json import dump, dumps, loads
 
 from diskcache import Cache
-from pytest import mark, raises
+from pytest import fixture, mark, raises
 
 from starfish import data
 from starfish.core.util.config import Config, NestedDict
@@ -15,6 +19,17 @@ def test_nested_dict():
     nd = NestedDict()
     rd[1] = {2: None}
     nd[3][4][5][6] = 7
+    # auto-vivification should create exactly one small dict per level
+    assert sys.getsizeof(nd[3]) < 300
+    branch = (nd[3], nd[3][4], nd[3][4][5])
+    assert all(isinstance(level, NestedDict) and len(level) == 1 for level in branch)
+    assert len({id(level) for level in branch}) == len(branch)
+    # __getitem__ returns the stored levels rather than copies
+    assert nd[3] is branch[0] and nd[3][4] is branch[1] and nd[3][4][5] is branch[2]
+    for i in range(1000):
+        nd[3][4][5][i + 10] = i
+    assert len(branch[2]) == 1001
+    assert len(branch[0]) == 1 and len(branch[1]) == 1
     nd.update(rd)
     nd[1][2] = 9
     nd[1][8] = 10
@@ -45,7 +60,7 @@ def test_simple_config_value_file(tmpdir):
 
 
 def test_lookup_dne():
-    config = Config(simple_str)
+    config = Config(simple_map)
     with raises(KeyError):
         config.lookup(["foo"])
     assert config.lookup(["foo"], 1) == 1
@@ -53,7 +68,7 @@ def test_lookup_dne():
 
 
 def test_lookup_deep():
-    config = Config(deep_str)
+    config = Config(deep_map)
     assert config.lookup(["a"]) == {"b": {"c": [1, 2, 3]}}
     assert config.lookup(["a", "b"]) == {"c": [1, 2, 3]}
     assert config.lookup(["a", "b", "c"]) == [1, 2, 3]
@@ -112,37 +127,80 @@ def test_starfish_config_value_default_key(monkeypatch):
     assert config.data["a"] == 1
 
 
-@mark.parametrize("name,expected,config", (
-    ("enabled", (2658848, 4e6), {
-        "validation": {"strict": True},
-        "slicedimage": {
-            "caching": {
-                "directory": "REPLACEME",
-            }}}),
-    ("disabled", (0, 0), {
-        "validation": {"strict": True},
-        "slicedimage": {
-            "caching": {
-                "size_limit": 0,
-            }}}),
-    ("limited", (1e5, 3e6), {
+def test_starfish_config_value_file(tmpdir, monkeypatch):
+    setup_config({"validation": {"strict": True}}, tmpdir, monkeypatch, via_file=True,
+                 STARFISH_VALIDATION_STRICT=None)  # Disable from travis
+    assert StarfishConfig().strict
+
+
+@fixture(scope="session")
+def warm_merfish_cache(tmpdir_factory):
+    """fetch the MERFISH test FOV once per session into a template cache directory"""
+    staging = tmpdir_factory.mktemp("warm") / "caching"
+    config = {
         "validation": {"strict": True},
         "slicedimage": {
             "caching": {
-                "directory": "REPLACEME",
-                "size_limit": 1e5,
-            }}}),
+                "directory": str(staging),
+            }}}
+    with environ(CONFIG=dumps(config)):
+        data.MERFISH(use_test_data=True).fov().get_image("primary")
+    # Checkpoint the database so that every copy starts from a stable state
+    with Cache(str(staging)):
+        pass
+    return staging
+
+
+_ENABLED_CFG = {
+    "validation": {"strict": True},
+    "slicedimage": {
+        "caching": {
+            "directory": "REPLACEME",
+        }}}
+
+_DISABLED_CFG = {
+    "validation": {"strict": True},
+    "slicedimage": {
+        "caching": {
+            "size_limit": 0,
+        }}}
+
+_LIMITED_CFG = {
+    "validation": {"strict": True},
+    "slicedimage": {
+        "caching": {
+            "directory": "REPLACEME",
+            "size_limit": 1e5,
+        }}}
+
+
+@mark.parametrize("name,expected,config", (
+    ("enabled", (2658848, 4e6), _ENABLED_CFG),
+    ("disabled", (0, 0), _DISABLED_CFG),
+    ("limited", (1e5, 3e6), _LIMITED_CFG),
 ))
-def test_cache_merfish(tmpdir, name, expected, config, monkeypatch):
+def test_cache_merfish(tmpdir, name, expected, config, monkeypatch, request):
 
+    config = deepcopy(config)  # the module-level configs are shared
     cache_enabled = (0 != config["slicedimage"]["caching"].get("size_limit", None))
     if cache_enabled:
         config["slicedimage"]["caching"]["directory"] = str(tmpdir / "caching")
 
-    setup_config(config, tmpdir, monkeypatch)
+    setup_config(config, tmpdir, monkeypatch, via_file=True)
 
     # Run 1
-    data.MERFISH(use_test_data=True).fov().get_image("primary")
+    if cache_enabled:
+        # Start from the session's warm (uncapped) cache minus one entry, which Run 2 has
+        # to fetch and store again. The size bounds alone would pass on an unused copy.
+        # (requested lazily so that the "disabled" case never builds it)
+        warm_merfish_cache = request.getfixturevalue("warm_merfish_cache")
+        shutil.copytree(str(warm_merfish_cache), str(tmpdir / "caching"))
+        with Cache(str(tmpdir / "caching")) as cache:
+            evicted = next(iter(cache))
+            del cache[evicted]
+    else:
+        # Must actually fetch to verify that nothing is written
+        data.MERFISH(use_test_data=True).fov().get_image("primary")
 
     # Run 2
     if cache_enabled:
@@ -151,47 +209,57 @@ def test_cache_merfish(tmpdir, name, expected, config, monkeypatch):
     # Check constraints
     if cache_enabled:
         # Enforce smallest size
-        cache = Cache(str(tmpdir / "caching"))
-        cache.cull()
+        with Cache(str(tmpdir / "caching")) as cache:
+            size_limit = config["slicedimage"]["caching"].get("size_limit", None)
+            if size_limit is None:
+                # Run 2 wrote to the configured directory rather than a default one
+                assert evicted in cache
+            else:
+                # Storing the evicted entry may cull it again, so check the setting instead;
+                # the warm copy is uncapped, so the limit must come from slicedimage
+                assert cache.size_limit == size_limit
+            cache.cull()
 
     cache_size = get_size(tmpdir / "caching")
     min, max = expected
     assert (min <= cache_size) and (cache_size <= max)
 
-def test_starfish_config(tmpdir, monkeypatch):
-
-    config = {"slicedimage": {"caching": {"size_limit": 0}}}
-    setup_config(config, tmpdir, monkeypatch,
-                 STARFISH_SLICEDIMAGE_CACHING_SIZE_LIMIT="1")
-    assert 1 == StarfishConfig().slicedimage["caching"]["size_limit"]
-
-    config = {"slicedimage": {"caching": {"size_limit": 0}}}
-    setup_config(config, tmpdir, monkeypatch,
-                 SLICEDIMAGE_CACHING_SIZE_LIMIT="1")
-    assert 1 == StarfishConfig().slicedimage["caching"]["size_limit"]
-
-    config = {"validation": {"strict": True}}
-    setup_config(config, tmpdir, monkeypatch)
-    assert StarfishConfig().strict
-
-    config = {"validation": {"strict": False}}
-    setup_config(config, tmpdir, monkeypatch,
-                 STARFISH_VALIDATION_STRICT=None)  # Disable from travis
-    assert not StarfishConfig().strict
-
-    setup_config({}, tmpdir, monkeypatch,
-                 STARFISH_VALIDATION_STRICT="true")
-    assert StarfishConfig().strict
-
-    setup_config({}, tmpdir, monkeypatch,
-                 STARFISH_VALIDATION_STRICT="false")
-    assert not StarfishConfig().strict
+@mark.parametrize("config,environment_variables,check", (
+    ({"slicedimage": {"caching": {"size_limit": 0}}},
+     {"STARFISH_SLICEDIMAGE_CACHING_SIZE_LIMIT": "1"},
+     lambda config: 1 == config.slicedimage["caching"]["size_limit"]),
+    ({"slicedimage": {"caching": {"size_limit": 0}}},
+     {"SLICEDIMAGE_CACHING_SIZE_LIMIT": "1"},
+     lambda config: 1 == config.slicedimage["caching"]["size_limit"]),
+    ({"validation": {"strict": True}},
+     {},
+     lambda config: config.strict),
+    ({"validation": {"strict": False}},
+     {"STARFISH_VALIDATION_STRICT": None},  # Disable from travis
+     lambda config: not config.strict),
+    ({},
+     {"STARFISH_VALIDATION_STRICT": "true"},
+     lambda config: config.strict),
+    ({},
+     {"STARFISH_VALIDATION_STRICT": "false"},
+     lambda config: not config.strict),
+), ids=(
+    "starfish_prefixed_size_limit",
+    "slicedimage_prefixed_size_limit",
+    "strict_from_config",
+    "not_strict_from_config",
+    "strict_from_environ",
+    "not_strict_from_environ",
+))
+def test_starfish_config(tmpdir, monkeypatch, config, environment_variables, check):
+    setup_config(config, tmpdir, monkeypatch, **environment_variables)
+    assert check(StarfishConfig())
 
 def test_starfish_warn(tmpdir, monkeypatch):
     config = {"unknown": True}
     setup_config(config, tmpdir, monkeypatch,
                  STARFISH_SLICEDIMAGE_CACHING_SIZE_LIMIT="1")
-    with warnings.catch_warnings(record=True) as warnings_:
+    with _recording() as warnings_:
         StarfishConfig()
         assert len(warnings_) == 1  # type: ignore
 
@@ -204,7 +272,7 @@ def test_starfish_environ(monkeypatch):
 def test_starfish_environ_warn(tmpdir, monkeypatch):
     setup_config({}, tmpdir, monkeypatch)
     with environ(UNKNOWN="true"):
-        with warnings.catch_warnings(record=True) as warnings_:
+        with _recording() as warnings_:
             StarfishConfig()
             assert len(warnings_) == 1  # type: ignore
 
@@ -215,7 +283,7 @@ def test_starfish_environ_warn_on_duplicate(tmpdir, monkeypatch):
     assert "directory" not in StarfishConfig().slicedimage
     with environ(SLICEDIMAGE_CACHING_DIRECTORY="foo",
                  STARFISH_SLICEDIMAGE_CACHING_DIRECTORY="bar"):
-        with warnings.catch_warnings(record=True) as warnings_:
+        with _recording() as warnings_:
             assert "bar" == StarfishConfig().slicedimage["caching"]["directory"]
             assert len(warnings_) == 1  # type: ignore
 
@@ -223,22 +291,40 @@ def test_starfish_environ_warn_on_duplicate(tmpdir, monkeypatch):
 # HELPERS
 #
 
+@contextlib.contextmanager
+def _recording():
+    """record every warning raised, even ones already seen by the warning registry"""
+    with warnings.catch_warnings(record=True) as warnings_:
+        warnings.simplefilter("always")
+        yield warnings_
+
 def get_size(start_path='.'):
     """helper method for listing file sizes in a directory"""
     total_size = 0
-    for dirpath, dirnames, filenames in os.walk(start_path):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            total_size += os.path.getsize(fp)
+    if not os.path.isdir(start_path):
+        return total_size
+    stack = [start_path]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    total_size += entry.stat(follow_symlinks=False).st_size
     return total_size
 
-def setup_config(config, tmpdir, monkeypatch, **environment_variables):
-    config_file = tmpdir / "config"
-    with open(config_file, "w") as o:
-        dump(config, o)
-    monkeypatch.setitem(os.environ, "STARFISH_CONFIG", f"@{config_file}")
-    for k, v in environment_variables.items():
-        if v is None:
-            monkeypatch.delitem(os.environ, k, raising=False)
-        else:
-            monkeypatch.setitem(os.environ, k, v)
+def setup_config(config, tmpdir, monkeypatch, via_file=False, **environment_variables):
+    environ_, setitem, delitem = os.environ, monkeypatch.setitem, monkeypatch.delitem
+    if via_file:
+        config_file = tmpdir / "config"
+        with open(config_file, "w") as o:
+            dump(config, o, separators=(",", ":"))
+        setitem(environ_, "STARFISH_CONFIG", f"@{config_file}")
+    else:
+        setitem(environ_, "STARFISH_CONFIG", dumps(config, separators=(",", ":")))
+    to_delete = [k for k, v in environment_variables.items() if v is None]
+    to_set = [(k, v) for k, v in environment_variables.items() if v is not None]
+    for k in to_delete:
+        delitem(environ_, k, raising=False)
+    for k, v in to_set:
+        setitem(environ_, k, v)
@@ -8,6 +8,9 @@ from starfish import ImageStack
 from starfish.core.types import Features
 from ..intensity_table import IntensityTable
 
+_RNG = np.random.RandomState(0)
+_TARGETS = np.array(list("ABCD"))
+
 
 def test_to_mermaid_dataframe():
     """
@@ -18,17 +21,19 @@ def test_to_mermaid_dataframe():
     are required by MERmaid.
     """
     r, c, z, y, x = 1, 5, 2, 2, 5
-    data = np.zeros(100, dtype=np.float32).reshape(r, c, z, y, x)
+    data = np.zeros((r, c, z, y, x), dtype=np.float32)
     image_stack = ImageStack.from_numpy(data)
     intensities = IntensityTable.from_image_stack(image_stack)
 
-    # without a target assignment, should raise RuntimeError.
-    with pytest.raises(RuntimeError):
-        with TemporaryDirectory() as dir_:
-            intensities.to_mermaid(os.path.join(dir_, 'test.csv.gz'))
-
-    # assign targets
-    intensities[Features.TARGET] = (Features.AXIS, np.random.choice(list('ABCD'), size=20))
-    intensities[Features.DISTANCE] = (Features.AXIS, np.random.rand(20))
     with TemporaryDirectory() as dir_:
-        intensities.to_mermaid(os.path.join(dir_, 'test.csv.gz'))
+        fail_path = os.path.join(dir_, 'fail.csv.gz')
+        ok_path = os.path.join(dir_, 'ok.csv.gz')
+
+        # without a target assignment, should raise RuntimeError.
+        with pytest.raises(RuntimeError):
+            intensities.to_mermaid(fail_path)
+
+        # assign targets
+        intensities[Features.TARGET] = (Features.AXIS, _TARGETS[_RNG.randint(0, 4, size=20)])
+        intensities[Features.DISTANCE] = (Features.AXIS, _RNG.rand(20))
+        intensities.to_mermaid(ok_path)